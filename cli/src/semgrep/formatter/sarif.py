@@ -1,12 +1,17 @@
 import json
+import re
+from functools import lru_cache
 from pathlib import Path
 from typing import Any
+from typing import Collection
 from typing import Dict
 from typing import Iterable
 from typing import List
 from typing import Mapping
 from typing import Optional
 from typing import Sequence
+from typing import Set
+from typing import Tuple
 
 import semgrep.semgrep_interfaces.semgrep_output_v1 as out
 from semgrep import __VERSION__
@@ -16,11 +21,102 @@ from semgrep.error import SemgrepError
 from semgrep.formatter.base import BaseFormatter
 from semgrep.rule import Rule
 from semgrep.rule_match import RuleMatch
-from semgrep.util import get_lines
 from semgrep.verbose_logging import getLogger
 
 logger = getLogger(__name__)
 
+try:
+    # Much faster than json for big reports. It isn't a dependency of
+    # semgrep, so this is only used when orjson is installed separately.
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
+_SEVERITY_MAP = {
+    RuleSeverity.INFO: "note",
+    RuleSeverity.WARNING: "warning",
+    RuleSeverity.ERROR: "error",
+}
+
+_ERROR_LEVEL_MAP = {
+    Level.ERROR.name.lower(): "error",
+    Level.WARN.name.lower(): "warning",
+}
+
+_SCHEMA_URI = (
+    "https://docs.oasis-open.org/sarif/sarif/v2.1.0/os/schemas/sarif-schema-2.1.0.json"
+)
+_SARIF_VERSION = "2.1.0"
+
+
+# json.dumps(ensure_ascii=True) escapes everything outside printable ASCII,
+# while orjson only escapes control characters
+_NON_ASCII_RE = re.compile(r"[^\x00-\x7e]")
+
+
+def _escape_non_ascii(match: "re.Match[str]") -> str:
+    code = ord(match.group())
+    if code > 0xFFFF:
+        # encoded as a UTF-16 surrogate pair, same as json
+        code -= 0x10000
+        return "\\u{:04x}\\u{:04x}".format(
+            0xD800 | (code >> 10), 0xDC00 | (code & 0x3FF)
+        )
+    return "\\u{:04x}".format(code)
+
+
+def _contains_float(obj: Any) -> bool:
+    if isinstance(obj, float):
+        return True
+    if isinstance(obj, dict):
+        return any(_contains_float(v) for v in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return any(_contains_float(v) for v in obj)
+    return False
+
+
+def _json_dumps(obj: Any, float_parts: Optional[Iterable[Any]] = None) -> str:
+    """
+    Serialize obj as JSON indented by two spaces, using orjson if available.
+
+    Produces the same output as json.dumps(obj, indent=2). Does not sort
+    keys; callers build their dicts in sorted order instead.
+
+    float_parts are the parts of obj that can contain floats, if the caller
+    knows them; by default all of obj is searched.
+    """
+    if float_parts is None:
+        float_parts = (obj,)
+    # orjson formats floats differently (1e-07 vs 1e-7) and writes NaN as
+    # null, so let json do those
+    if orjson is not None and not any(_contains_float(p) for p in float_parts):
+        try:
+            dumped: str = orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+        except TypeError:
+            # orjson.JSONEncodeError, e.g. on integers that don't fit in 64 bits
+            pass
+        else:
+            # JSON syntax is all ASCII, so this only touches string contents
+            return _NON_ASCII_RE.sub(_escape_non_ascii, dumped)
+    return json.dumps(obj, indent=2)
+
+
+def _location_key(location: out.Location) -> Tuple[str, int, int]:
+    # out.Location isn't hashable, since Fpath isn't
+    return (location.path.value, location.start.line, location.start.col)
+
+
+@lru_cache(maxsize=128)
+def _cached_lines(path: str) -> List[str]:
+    """
+    Return all lines of the given file, keeping line endings.
+
+    Taint traces usually point many times into the same few files, so this
+    is cached; SarifFormatter.format() clears the cache once it is done.
+    """
+    with Path(path).open(errors="replace") as fd:
+        return fd.readlines()
+
 
 class SarifFormatter(BaseFormatter):
     @staticmethod
@@ -28,181 +124,231 @@ class SarifFormatter(BaseFormatter):
         """
         Get two lines before the taint, and 2 lines after for better code snippet
         """
-        content = "".join(
-            get_lines(
-                Path(location.path.value), location.start.line, location.end.line + 2
-            )
-        ).rstrip("\n")
-        snippet_before = "".join(
-            get_lines(
-                Path(location.path.value),
-                location.start.line - 2,
-                location.end.line - 1,
-            )
-        ).lstrip("\n")
+        start = location.start.line - 1  # zero-indexed
+        before_start = max(0, start - 2)
+        window = _cached_lines(location.path.value)[
+            before_start : location.end.line + 2
+        ]
+        split = start - before_start
+        snippet_before = "".join(window[:split]).lstrip("\n")
+        content = "".join(window[split:]).rstrip("\n")
         start_highlight = len(snippet_before) + location.start.col
-        end_hightlight = len(snippet_before) + location.end.col
-        return "".join([snippet_before, content]), start_highlight, end_hightlight
+        # the end column is on the location's last line, after its other lines
+        end_line_offset = len(snippet_before) + sum(
+            len(line) for line in window[split : split + location.end.line - start - 1]
+        )
+        end_hightlight = end_line_offset + location.end.col
+        return snippet_before + content, start_highlight, end_hightlight
 
     @staticmethod
     def _create_sarif_location_dict(
         var_type: str,
         snippet: str,
         location: out.Location,
-        rule_match: RuleMatch,
+        artifact_location: Mapping[str, str],
         nesting_level: int = -1,
     ) -> Mapping[str, Any]:
-        message = f"{var_type}: '{snippet.strip()}' @ '{str(location.path.value)}:{str(location.start.line)}'"
+        start_line = location.start.line
+        message = {
+            "text": f"{var_type}: '{snippet.strip()}' @ '{location.path.value}:{start_line}'"
+        }
         (
             extended_snippet,
             start_highlight,
             end_highlight,
         ) = SarifFormatter._generate_taint_snippet(location)
-        sarif_dict = {
+        region = {
+            "endColumn": end_highlight,
+            "endLine": location.end.line,
+            "message": message,
+            "snippet": {"text": extended_snippet},
+            "startColumn": start_highlight,
+            "startLine": start_line,
+        }
+        sarif_dict: Dict[str, Any] = {
             "location": {
-                "message": {"text": message},
+                "message": message,
                 "physicalLocation": {
-                    "artifactLocation": {"uri": str(rule_match.path)},
-                    "region": {
-                        "startLine": location.start.line,
-                        "startColumn": start_highlight,
-                        "endLine": location.end.line,
-                        "endColumn": end_highlight,
-                        "snippet": {"text": extended_snippet},
-                        "message": {"text": message},
-                    },
+                    "artifactLocation": artifact_location,
+                    "region": region,
                 },
             }
         }
         if nesting_level != -1:
-            sarif_dict["nestingLevel"] = nesting_level  # type: ignore
+            sarif_dict["nestingLevel"] = nesting_level
         return sarif_dict
 
     @staticmethod
     def _taint_obj_intermediate_vars_to_thread_flow_locations_sarif(
-        intermediate_var: Any, rule_match: RuleMatch
+        intermediate_var: Any, artifact_location: Mapping[str, str]
     ) -> Any:
         return SarifFormatter._create_sarif_location_dict(
             "Propagator ",
             "".join(intermediate_var.content),
             intermediate_var.location,
-            rule_match,
+            artifact_location,
             nesting_level=0,
         )
 
     @staticmethod
-    def _rec_taint_obj_to_thread_flow_locations_sarif(
-        var_type: str, taint_obj: Any, rule_match: RuleMatch
-    ) -> List[Any]:
-        taint_trace = []
+    def _unwind_taint_obj(taint_obj: Any) -> Tuple[List[out.CliCall], Any]:
+        """
+        Return the calls a taint trace goes through, outermost first, and the
+        object the trace ends in (normally a CliLoc)
+        """
+        # A trace is a chain: a CliMatchCallTrace wraps a CliLoc or a CliCall,
+        # and a CliCall's value[2] is the CliMatchCallTrace of the callee.
+        # These ATD variants are final classes, so compare their exact type
+        # rather than paying for an isinstance() chain at every node.
+        calls = []
+        taint_type = type(taint_obj)
+        while True:
+            if taint_type is out.CliMatchCallTrace:
+                taint_obj = taint_obj.value
+            elif taint_type is out.CliCall:
+                calls.append(taint_obj)
+                taint_obj = taint_obj.value[2]
+            else:
+                break
+            taint_type = type(taint_obj)
+        return calls, taint_obj
 
-        if isinstance(taint_obj, out.CliMatchCallTrace):
-            taint_trace += SarifFormatter._rec_taint_obj_to_thread_flow_locations_sarif(
-                var_type, taint_obj.value, rule_match
-            )
+    @staticmethod
+    def _taint_obj_to_thread_flow_locations_sarif(
+        var_type: str,
+        taint_obj: Any,
+        rule_match: RuleMatch,
+        sink_snippet: Optional[str] = None,
+        propagators: Optional[Set[Tuple[str, int, int]]] = None,
+    ) -> List[Any]:
+        # Emit locations from the innermost call outwards, without recursing.
+        # If given, propagators collects the locations emitted for the calls.
+        calls, taint_obj = SarifFormatter._unwind_taint_obj(taint_obj)
 
-        if isinstance(taint_obj, out.CliCall):
-            taint_trace += SarifFormatter._rec_taint_obj_to_thread_flow_locations_sarif(
-                var_type, taint_obj.value[2], rule_match
+        taint_trace = []
+        # every location of the trace points into the matched file, so they
+        # can all share a single artifactLocation object
+        artifact_location = {"uri": str(rule_match.path)}
+
+        if type(taint_obj) is out.CliLoc:
+            nesting_level = 0
+            if var_type.lower() == "sink":
+                nesting_level = 1
+                if sink_snippet is None:
+                    sink_snippet = "".join(rule_match.lines)
+                snippet = sink_snippet
+            else:
+                snippet = "".join(taint_obj.value[1])
+            taint_trace.append(
+                SarifFormatter._create_sarif_location_dict(
+                    var_type,
+                    snippet,
+                    taint_obj.value[0],
+                    artifact_location,
+                    nesting_level,
+                )
             )
 
-            for intermediate_var in taint_obj.value[1]:
+        for call in reversed(calls):
+            for intermediate_var in call.value[1]:
+                if propagators is not None:
+                    propagators.add(_location_key(intermediate_var.location))
                 taint_trace.append(
                     SarifFormatter._taint_obj_intermediate_vars_to_thread_flow_locations_sarif(
-                        intermediate_var, rule_match
+                        intermediate_var, artifact_location
                     )
                 )
-
-        # the taint object can be an instance of CliLoc, CliCall or CliMatchCallTrace
-        if isinstance(taint_obj, out.CliLoc):
-            location = taint_obj.value[0]
-            snippet = "".join(taint_obj.value[1])
-        elif isinstance(taint_obj, out.CliCall):
-            var_type = "Propagator "
-            location = taint_obj.value[0][0]
-            snippet = "".join(taint_obj.value[0][1])
-        else:
-            return taint_trace
-
-        nesting_level = 0
-        if var_type.lower() == "sink":
-            nesting_level = 1
-            snippet = "".join(rule_match.lines)
-
-        return taint_trace + [
-            SarifFormatter._create_sarif_location_dict(
-                var_type, snippet, location, rule_match, nesting_level
+            location, content = call.value[0]
+            if propagators is not None:
+                propagators.add(_location_key(location))
+            taint_trace.append(
+                SarifFormatter._create_sarif_location_dict(
+                    "Propagator ", "".join(content), location, artifact_location, 0
+                )
             )
-        ]
+
+        return taint_trace
 
     @staticmethod
-    def _taint_source_to_thread_flow_locations_sarif(rule_match: RuleMatch) -> Any:
-        dataflow_trace = rule_match.dataflow_trace
+    def _taint_source_to_thread_flow_locations_sarif(
+        rule_match: RuleMatch,
+        dataflow_trace: Optional[out.CliMatchDataflowTrace] = None,
+        propagators: Optional[Set[Tuple[str, int, int]]] = None,
+    ) -> Any:
+        if dataflow_trace is None:
+            dataflow_trace = rule_match.dataflow_trace
         if not dataflow_trace:
             return None
         taint_source = dataflow_trace.taint_source
         if not taint_source:
             return None
-        # calculate source flow - recursive
-        return SarifFormatter._rec_taint_obj_to_thread_flow_locations_sarif(
-            "Source", taint_source, rule_match
+        # calculate source flow
+        return SarifFormatter._taint_obj_to_thread_flow_locations_sarif(
+            "Source", taint_source, rule_match, propagators=propagators
         )
 
     @staticmethod
-    def _intermediate_vars_to_thread_flow_locations_sarif(rule_match: RuleMatch) -> Any:
-        dataflow_trace = rule_match.dataflow_trace
+    def _intermediate_vars_to_thread_flow_locations_sarif(
+        rule_match: RuleMatch,
+        dataflow_trace: Optional[out.CliMatchDataflowTrace] = None,
+        skip: Collection[Tuple[str, int, int]] = (),
+    ) -> Any:
+        if dataflow_trace is None:
+            dataflow_trace = rule_match.dataflow_trace
         if not dataflow_trace:
             return None
         intermediate_vars = dataflow_trace.intermediate_vars
         if not intermediate_vars:
             return None
-        intermediate_var_locations = []
-        for intermediate_var in intermediate_vars:
-            intermediate_var_locations.append(
-                SarifFormatter._create_sarif_location_dict(
-                    "Propagator ",
-                    "".join(intermediate_var.content),
-                    intermediate_var.location,
-                    rule_match,
-                    nesting_level=0,
-                )
+        artifact_location = {"uri": str(rule_match.path)}
+        return [
+            SarifFormatter._taint_obj_intermediate_vars_to_thread_flow_locations_sarif(
+                intermediate_var, artifact_location
             )
-        return intermediate_var_locations
+            for intermediate_var in intermediate_vars
+            if _location_key(intermediate_var.location) not in skip
+        ]
 
     @staticmethod
-    def _dataflow_trace_to_thread_flows_sarif(rule_match: RuleMatch) -> Any:
+    def _dataflow_trace_to_thread_flows_sarif(
+        rule_match: RuleMatch,
+        sink_snippet: Optional[str] = None,
+        dataflow_trace: Optional[out.CliMatchDataflowTrace] = None,
+    ) -> Any:
         thread_flows = []
         locations = []
 
-        dataflow_trace = rule_match.dataflow_trace
+        if dataflow_trace is None:
+            dataflow_trace = rule_match.dataflow_trace
         if not dataflow_trace:
             return None
         taint_source = dataflow_trace.taint_source
         # TODO: deal with taint sink
         intermediate_vars = dataflow_trace.intermediate_vars
 
+        # locations already rendered as propagators by the source trace
+        source_propagators: Set[Tuple[str, int, int]] = set()
         if taint_source:
             # calculate intermediate vars/calls for the source
             locations += SarifFormatter._taint_source_to_thread_flow_locations_sarif(
-                rule_match
+                rule_match, dataflow_trace, source_propagators
             )
 
         if intermediate_vars:
+            # don't show a propagator twice if the source trace already has it
             intermediate_var_locations = (
                 SarifFormatter._intermediate_vars_to_thread_flow_locations_sarif(
-                    rule_match
+                    rule_match, dataflow_trace, source_propagators
                 )
             )
             if intermediate_var_locations:
-                for intermediate_var_location in intermediate_var_locations:
-                    locations.append(intermediate_var_location)
+                locations.extend(intermediate_var_locations)
 
-        sink_thread_trace = (
-            SarifFormatter._rec_taint_obj_to_thread_flow_locations_sarif(
-                "Sink", dataflow_trace.taint_sink, rule_match
-            )[::-1]
+        # the sink trace goes from the sink outwards; show it the other way round
+        sink_thread_trace = SarifFormatter._taint_obj_to_thread_flow_locations_sarif(
+            "Sink", dataflow_trace.taint_sink, rule_match, sink_snippet
         )
-        locations += sink_thread_trace
+        locations.extend(reversed(sink_thread_trace))
 
         thread_flows.append({"locations": locations})
         return thread_flows
@@ -210,8 +356,11 @@ class SarifFormatter(BaseFormatter):
     @staticmethod
     def _dataflow_trace_to_codeflow_sarif(
         rule_match: RuleMatch,
+        sink_snippet: Optional[str] = None,
+        dataflow_trace: Optional[out.CliMatchDataflowTrace] = None,
     ) -> Optional[Mapping[str, Any]]:
-        dataflow_trace = rule_match.dataflow_trace
+        if dataflow_trace is None:
+            dataflow_trace = rule_match.dataflow_trace
         if not dataflow_trace:
             return None
         taint_source = dataflow_trace.taint_source
@@ -224,14 +373,16 @@ class SarifFormatter(BaseFormatter):
         elif isinstance(taint_source.value, out.CliLoc):
             location = taint_source.value.value[0]
 
-        code_flow_sarif = {
+        code_flow_sarif: Dict[str, Any] = {
             "message": {
-                "text": f"Untrusted dataflow from {str(location.path.value)}:{str(location.start.line)} "
-                f"to {str(rule_match.path)}:{str(rule_match.start.line)}"
+                "text": f"Untrusted dataflow from {location.path.value}:{location.start.line} "
+                f"to {rule_match.path}:{rule_match.start.line}"
             },
         }
 
-        thread_flows = SarifFormatter._dataflow_trace_to_thread_flows_sarif(rule_match)
+        thread_flows = SarifFormatter._dataflow_trace_to_thread_flows_sarif(
+            rule_match, sink_snippet, dataflow_trace
+        )
         if thread_flows:
             code_flow_sarif["threadFlows"] = thread_flows
 
@@ -241,50 +392,59 @@ class SarifFormatter(BaseFormatter):
     def _rule_match_to_sarif(
         rule_match: RuleMatch, dataflow_traces: bool
     ) -> Mapping[str, Any]:
-        rule_match_sarif: Dict[str, Any] = {
-            "ruleId": rule_match.rule_id,
-            "message": {"text": rule_match.message},
-            "locations": [
-                {
-                    "physicalLocation": {
-                        "artifactLocation": {
-                            "uri": str(rule_match.path),
-                            "uriBaseId": "%SRCROOT%",
-                        },
-                        "region": {
-                            "snippet": {"text": "".join(rule_match.lines).rstrip()},
-                            "startLine": rule_match.start.line,
-                            "startColumn": rule_match.start.col,
-                            "endLine": rule_match.end.line,
-                            "endColumn": rule_match.end.col,
-                        },
-                    }
-                }
-            ],
-            "fingerprints": {"matchBasedId/v1": rule_match.match_based_id},
-            "properties": {},
+        path = str(rule_match.path)
+        lines_str = "".join(rule_match.lines)
+        code_flows = None
+        if dataflow_traces:
+            # RuleMatch.dataflow_trace reads every location of the trace from
+            # disk, so compute it once and hand it down
+            dataflow_trace = rule_match.dataflow_trace
+            if dataflow_trace:
+                code_flows = SarifFormatter._dataflow_trace_to_codeflow_sarif(
+                    rule_match, lines_str, dataflow_trace
+                )
+        fix = SarifFormatter._rule_match_to_sarif_fix(rule_match, path)
+
+        # Keys are inserted in sorted order, see format()
+        rule_match_sarif: Dict[str, Any] = {}
+        if code_flows:
+            rule_match_sarif["codeFlows"] = [code_flows]
+        rule_match_sarif["fingerprints"] = {
+            "matchBasedId/v1": rule_match.match_based_id
         }
-
-        if dataflow_traces and rule_match.dataflow_trace:
-            code_flows = SarifFormatter._dataflow_trace_to_codeflow_sarif(rule_match)
-            if code_flows:
-                rule_match_sarif["codeFlows"] = [code_flows]
-
-        if rule_match.is_ignored:
-            rule_match_sarif["suppressions"] = [{"kind": "inSource"}]
-
-        fix = SarifFormatter._rule_match_to_sarif_fix(rule_match)
-
         if fix is not None:
             rule_match_sarif["fixes"] = [fix]
-
-        if rule_match.exposure_type:
-            rule_match_sarif["properties"]["exposure"] = rule_match.exposure_type
+        rule_match_sarif["locations"] = [
+            {
+                "physicalLocation": {
+                    "artifactLocation": {
+                        "uri": path,
+                        "uriBaseId": "%SRCROOT%",
+                    },
+                    "region": {
+                        "endColumn": rule_match.end.col,
+                        "endLine": rule_match.end.line,
+                        "snippet": {"text": lines_str.rstrip()},
+                        "startColumn": rule_match.start.col,
+                        "startLine": rule_match.start.line,
+                    },
+                }
+            }
+        ]
+        rule_match_sarif["message"] = {"text": rule_match.message}
+        rule_match_sarif["properties"] = (
+            {"exposure": rule_match.exposure_type} if rule_match.exposure_type else {}
+        )
+        rule_match_sarif["ruleId"] = rule_match.rule_id
+        if rule_match.is_ignored:
+            rule_match_sarif["suppressions"] = [{"kind": "inSource"}]
 
         return rule_match_sarif
 
     @staticmethod
-    def _rule_match_to_sarif_fix(rule_match: RuleMatch) -> Optional[Mapping[str, Any]]:
+    def _rule_match_to_sarif_fix(
+        rule_match: RuleMatch, path: str
+    ) -> Optional[Mapping[str, Any]]:
         # if rule_match.extra.get("dependency_matches"):
         fixed_lines = rule_match.extra.get("fixed_lines")
 
@@ -293,85 +453,84 @@ class SarifFormatter(BaseFormatter):
             return None
         description_text = f"{rule_match.message}\n Autofix: {description}"
         fix_sarif = {
-            "description": {"text": description_text},
             "artifactChanges": [
                 {
-                    "artifactLocation": {"uri": str(rule_match.path)},
+                    "artifactLocation": {"uri": path},
                     "replacements": [
                         {
                             "deletedRegion": {
-                                "startLine": rule_match.start.line,
-                                "startColumn": rule_match.start.col,
-                                "endLine": rule_match.end.line,
                                 "endColumn": rule_match.end.col,
+                                "endLine": rule_match.end.line,
+                                "startColumn": rule_match.start.col,
+                                "startLine": rule_match.start.line,
                             },
                             "insertedContent": {"text": "\n".join(fixed_lines)},
                         }
                     ],
                 }
             ],
+            "description": {"text": description_text},
         }
         return fix_sarif
 
     @staticmethod
     def _rule_to_sarif(rule: Rule) -> Mapping[str, Any]:
+        md = rule.metadata
+        get = md.get
         severity = SarifFormatter._rule_to_sarif_severity(rule)
         tags = SarifFormatter._rule_to_sarif_tags(rule)
-        security_severity = rule.metadata.get("security-severity")
+        security_severity = get("security-severity")
 
+        rule_properties: Dict[str, Any] = {"precision": "very-high"}
         if security_severity is not None:
-            rule_json = {
-                "id": rule.id,
-                "name": rule.id,
-                "shortDescription": {"text": f"Semgrep Finding: {rule.id}"},
-                "fullDescription": {"text": rule.message},
-                "defaultConfiguration": {"level": severity},
-                "properties": {
-                    "precision": "very-high",
-                    "tags": tags,
-                    "security-severity": security_severity,
-                },
-            }
-        else:
-            rule_json = {
-                "id": rule.id,
-                "name": rule.id,
-                "shortDescription": {"text": f"Semgrep Finding: {rule.id}"},
-                "fullDescription": {"text": rule.message},
-                "defaultConfiguration": {"level": severity},
-                "properties": {"precision": "very-high", "tags": tags},
-            }
+            rule_properties["security-severity"] = security_severity
+        rule_properties["tags"] = tags
 
-        rule_url = rule.metadata.get("source")
+        rule_url = get("source")
         references = []
 
         if rule_url is not None:
-            rule_json["helpUri"] = rule_url
             references.append(f"[Semgrep Rule]({rule_url})")
 
-        if rule.metadata.get("references"):
-            ref = rule.metadata["references"]
+        if get("references"):
+            ref = md["references"]
             # TODO: Handle cases which aren't URLs in custom rules, wont be a problem semgrep-rules.
             references.extend(
                 [f"[{r}]({r})" for r in ref]
                 if isinstance(ref, list)
                 else [f"[{ref}]({ref})"]
             )
-        if references:
+
+        rule_help: Optional[Mapping[str, str]] = None
+        rule_help_text = get("help")
+        if rule_help_text:
+            rule_help = {"text": rule_help_text}
+        elif references:
             r = "".join(
                 [f" - {references_markdown}\n" for references_markdown in references]
             )
-            rule_json["help"] = {
-                "text": rule.message,
+            rule_help = {
                 "markdown": f"{rule.message}\n\n<b>References:</b>\n{r}",
+                "text": rule.message,
             }
-        rule_short_description = rule.metadata.get("shortDescription")
-        if rule_short_description:
-            rule_json["shortDescription"] = {"text": rule_short_description}
 
-        rule_help_text = rule.metadata.get("help")
-        if rule_help_text:
-            rule_json["help"] = {"text": rule_help_text}
+        rule_short_description = (
+            get("shortDescription") or f"Semgrep Finding: {rule.id}"
+        )
+
+        # Keys are inserted in sorted order, see format()
+        rule_json: Dict[str, Any] = {
+            "defaultConfiguration": {"level": severity},
+            "fullDescription": {"text": rule.message},
+        }
+        if rule_help is not None:
+            rule_json["help"] = rule_help
+        if rule_url is not None:
+            rule_json["helpUri"] = rule_url
+        rule_json["id"] = rule.id
+        rule_json["name"] = rule.id
+        rule_json["properties"] = rule_properties
+        rule_json["shortDescription"] = {"text": rule_short_description}
 
         return rule_json
 
@@ -382,68 +541,56 @@ class SarifFormatter(BaseFormatter):
 
         See https://github.com/oasis-tcs/sarif-spec/blob/a6473580/Schemata/sarif-schema-2.1.0.json#L1566
         """
-        mapping = {
-            RuleSeverity.INFO: "note",
-            RuleSeverity.WARNING: "warning",
-            RuleSeverity.ERROR: "error",
-        }
-        return mapping[rule.severity]
+        return _SEVERITY_MAP[rule.severity]
 
     @staticmethod
     def _rule_to_sarif_tags(rule: Rule) -> Sequence[str]:
         """
         Tags to display on SARIF-compliant UIs, such as GitHub security scans.
         """
-        result = []
-        if "cwe" in rule.metadata:
-            cwe = rule.metadata["cwe"]
-            result.extend(cwe if isinstance(cwe, list) else [cwe])
-            result.append("security")
-        if "owasp" in rule.metadata:
-            owasp = rule.metadata["owasp"]
-            result.extend(
-                [f"OWASP-{o}" for o in owasp]
-                if isinstance(owasp, list)
-                else [f"OWASP-{owasp}"]
-            )
-        if rule.metadata.get("confidence"):
-            confidence = rule.metadata["confidence"]
-            result.append(f"{confidence} CONFIDENCE")
-        if (
-            "semgrep.policy" in rule.metadata
-            and "slug" in rule.metadata["semgrep.policy"]
-        ):
+        md = rule.metadata
+        result: Set[str] = set()
+        if "cwe" in md:
+            cwe = md["cwe"]
+            if isinstance(cwe, list):
+                result.update(cwe)
+            else:
+                result.add(cwe)
+            result.add("security")
+        if "owasp" in md:
+            owasp = md["owasp"]
+            if isinstance(owasp, list):
+                result.update(f"OWASP-{o}" for o in owasp)
+            else:
+                result.add(f"OWASP-{owasp}")
+        confidence = md.get("confidence")
+        if confidence:
+            result.add(f"{confidence} CONFIDENCE")
+        if "semgrep.policy" in md and "slug" in md["semgrep.policy"]:
             # https://github.com/returntocorp/semgrep-app/blob/8d2e6187b7daa2b20c49839a4fcb67e560202aa8/frontend/src/pages/ruleBoard/constants/constants.tsx#L74
             # this should be "rule-board-audit", "rule-board-block", or "rule-board-pr-comments"
-            slug = rule.metadata["semgrep.policy"]["slug"]
-            result.append(slug)
+            result.add(md["semgrep.policy"]["slug"])
 
-        for tags in rule.metadata.get("tags", []):
-            result.append(tags)
+        result.update(md.get("tags", []))
 
-        return sorted(set(result))
+        return sorted(result)
 
     @staticmethod
     def _semgrep_error_to_sarif_notification(error: SemgrepError) -> Mapping[str, Any]:
         error_dict = error.to_dict()
-        descriptor = error_dict["type"]
-
-        error_to_sarif_level = {
-            Level.ERROR.name.lower(): "error",
-            Level.WARN.name.lower(): "warning",
-        }
-        level = error_to_sarif_level[error_dict["level"]]
+        get = error_dict.get
 
-        message = error_dict.get("message")
+        # an empty message is still a message, so don't use `or` here
+        message = get("message")
         if message is None:
-            message = error_dict.get("long_msg")
+            message = get("long_msg")
         if message is None:
-            message = error_dict.get("short_msg", "")
+            message = get("short_msg", "")
 
         return {
-            "descriptor": {"id": descriptor},
+            "descriptor": {"id": error_dict["type"]},
+            "level": _ERROR_LEVEL_MAP[error_dict["level"]],
             "message": {"text": message},
-            "level": level,
         }
 
     def keep_ignores(self) -> bool:
@@ -470,35 +617,56 @@ class SarifFormatter(BaseFormatter):
         - Full specification is at:
             https://docs.oasis-open.org/sarif/sarif/v2.1.0/cs01/sarif-v2.1.0-cs01.html
         """
-
+        # bind these once rather than looking them up for every item
+        dataflow_traces = extra["dataflow_traces"]
+        rule_to_sarif = self._rule_to_sarif
+        rule_match_to_sarif = self._rule_match_to_sarif
+        error_to_sarif = self._semgrep_error_to_sarif_notification
+
+        # All the dicts below are built with their keys already in sorted
+        # order, so the output is predictable (this helps with snapshot tests,
+        # etc.) without paying for sort_keys=True on every object.
+        # serialize each rule object only once, even if it is passed in twice
+        seen: Dict[int, Mapping[str, Any]] = {}
+        rules_sarif = []
+        for rule in rules:
+            rule_sarif = seen.get(id(rule))
+            if rule_sarif is None:
+                rule_sarif = seen[id(rule)] = rule_to_sarif(rule)
+            rules_sarif.append(rule_sarif)
+        try:
+            results_sarif = [
+                rule_match_to_sarif(rule_match, dataflow_traces)
+                for rule_match in rule_matches
+            ]
+        finally:
+            # the file contents are only needed while building the results
+            _cached_lines.cache_clear()
         output_dict = {
-            "$schema": "https://docs.oasis-open.org/sarif/sarif/v2.1.0/os/schemas/sarif-schema-2.1.0.json",
-            "version": "2.1.0",
+            "$schema": _SCHEMA_URI,
             "runs": [
                 {
-                    "tool": {
-                        "driver": {
-                            "name": "semgrep",
-                            "semanticVersion": __VERSION__,
-                            "rules": [self._rule_to_sarif(rule) for rule in rules],
-                        }
-                    },
-                    "results": [
-                        self._rule_match_to_sarif(rule_match, extra["dataflow_traces"])
-                        for rule_match in rule_matches
-                    ],
                     "invocations": [
                         {
                             "executionSuccessful": True,
                             "toolExecutionNotifications": [
-                                self._semgrep_error_to_sarif_notification(error)
+                                error_to_sarif(error)
                                 for error in semgrep_structured_errors
                             ],
                         }
                     ],
+                    "results": results_sarif,
+                    "tool": {
+                        "driver": {
+                            "name": "semgrep",
+                            "rules": rules_sarif,
+                            "semanticVersion": __VERSION__,
+                        }
+                    },
                 },
             ],
+            "version": _SARIF_VERSION,
         }
 
-        # Sort keys for predictable output. This helps with snapshot tests, etc.
-        return json.dumps(output_dict, sort_keys=True, indent=2)
+        # floats can only come from rule metadata
+        return _json_dumps(output_dict, seen.values())
@@ -1,4 +1,5 @@
 import builtins
+import json
 from io import StringIO
 from pathlib import Path
 from textwrap import dedent
@@ -8,6 +9,9 @@ from ruamel.yaml import YAML
 
 import semgrep.output_from_core as core
 from semgrep.constants import RuleSeverity
+from semgrep.error import SemgrepError
+from semgrep.formatter import sarif
+from semgrep.formatter.sarif import _cached_lines
 from semgrep.formatter.sarif import SarifFormatter
 from semgrep.rule import Rule
 from semgrep.rule_lang import EmptySpan
@@ -17,7 +21,13 @@ from semgrep.rule_match import RuleMatch
 yaml = YAML(typ="rt")
 
 
-def create_taint_rule_match():
+@pytest.fixture(autouse=True)
+def clear_sarif_file_cache() -> None:
+    # the tests mock different contents for the same file names
+    _cached_lines.cache_clear()
+
+
+def create_taint_rule_match(**kwargs):
     match = RuleMatch(
         message="message",
         severity=RuleSeverity.ERROR,
@@ -62,6 +72,7 @@ def create_taint_rule_match():
                 engine_kind=core.EngineKind(core.OSS()),
             ),
         ),
+        **kwargs,
     )
     return match
 
@@ -129,7 +140,7 @@ def test_intermediate_vars_to_thread_flow_locations_sarif(mocker):
 
 
 @pytest.mark.quick
-def test_rec_taint_obj_to_thread_flow_locations_sarif(mocker):
+def test_taint_obj_to_thread_flow_locations_sarif(mocker):
     # https://docs.oasis-open.org/sarif/sarif/v2.1.0/cs01/sarif-v2.1.0-cs01.html#_Toc16012707
     file_content = dedent(
         """
@@ -141,10 +152,8 @@ def test_rec_taint_obj_to_thread_flow_locations_sarif(mocker):
     mocker.patch.object(Path, "open", mocker.mock_open(read_data=file_content))
     mocker.patch.object(builtins, "open", mocker.mock_open(read_data=file_content))
     taint_rule_match = create_taint_rule_match()
-    thread_flow_locations = (
-        SarifFormatter._rec_taint_obj_to_thread_flow_locations_sarif(
-            "Sink", taint_rule_match.dataflow_trace.taint_sink, taint_rule_match
-        )
+    thread_flow_locations = SarifFormatter._taint_obj_to_thread_flow_locations_sarif(
+        "Sink", taint_rule_match.dataflow_trace.taint_sink, taint_rule_match
     )
 
     assert bool(thread_flow_locations[0].get("location")), (
@@ -226,3 +235,180 @@ def test_rule_to_sarif_tags():
     tags = SarifFormatter._rule_to_sarif_tags(rule)
 
     assert all([isinstance(tag, str) for tag in tags])
+
+
+@pytest.mark.quick
+def test_dataflow_trace_to_thread_flows_sarif_no_duplicate_propagators(mocker):
+    file_content = "".join(f"line {i}\n" for i in range(1, 21))
+    mocker.patch.object(Path, "open", mocker.mock_open(read_data=file_content))
+    mocker.patch.object(builtins, "open", mocker.mock_open(read_data=file_content))
+
+    def location(line):
+        return core.Location(
+            path=core.Fpath("foo.py"),
+            start=core.Position(line, 1, 0),
+            end=core.Position(line, 5, 4),
+        )
+
+    taint_rule_match = RuleMatch(
+        message="message",
+        severity=RuleSeverity.ERROR,
+        match=core.CoreMatch(
+            rule_id=core.RuleId("rule.id"),
+            location=location(15),
+            extra=core.CoreMatchExtra(
+                metavars=core.Metavars({}),
+                dataflow_trace=core.CoreMatchDataflowTrace(
+                    taint_source=core.CoreMatchCallTrace(
+                        core.CoreCall(
+                            (
+                                location(10),
+                                [core.CoreMatchIntermediateVar(location(13))],
+                                core.CoreMatchCallTrace(core.CoreLoc(location(8))),
+                            )
+                        )
+                    ),
+                    intermediate_vars=[
+                        core.CoreMatchIntermediateVar(location(13)),
+                        core.CoreMatchIntermediateVar(location(14)),
+                    ],
+                    taint_sink=core.CoreMatchCallTrace(core.CoreLoc(location(15))),
+                ),
+                engine_kind=core.EngineKind(core.OSS()),
+            ),
+        ),
+    )
+    thread_flows = SarifFormatter._dataflow_trace_to_thread_flows_sarif(
+        taint_rule_match
+    )
+
+    start_lines = [
+        location["location"]["physicalLocation"]["region"]["startLine"]
+        for location in thread_flows[0]["locations"]
+    ]
+    assert start_lines == [8, 13, 10, 14, 15]
+
+
+@pytest.mark.quick
+def test_generate_taint_snippet_multiline(mocker):
+    file_content = "".join(f"line {i}\n" for i in range(1, 9))
+    mocker.patch.object(Path, "open", mocker.mock_open(read_data=file_content))
+    location = core.Location(
+        path=core.Fpath("foo.py"),
+        start=core.Position(3, 1, 14),
+        end=core.Position(4, 7, 27),
+    )
+
+    snippet, start_highlight, end_highlight = SarifFormatter._generate_taint_snippet(
+        location
+    )
+
+    # two lines of context on each side, and no line repeated
+    assert snippet == "line 1\nline 2\nline 3\nline 4\nline 5\nline 6"
+    assert start_highlight == len("line 1\nline 2\n") + 1
+    assert end_highlight == len("line 1\nline 2\nline 3\n") + 7
+    assert snippet[start_highlight - 1 : end_highlight - 1] == "line 3\nline 4"
+
+
+@pytest.mark.quick
+def test_generate_taint_snippet_first_lines(mocker):
+    file_content = "".join(f"line {i}\n" for i in range(1, 9))
+    mocker.patch.object(Path, "open", mocker.mock_open(read_data=file_content))
+
+    for line, expected in [
+        (1, "line 1\nline 2\nline 3"),
+        (2, "line 1\nline 2\nline 3\nline 4"),
+    ]:
+        location = core.Location(
+            path=core.Fpath("foo.py"),
+            start=core.Position(line, 1, 0),
+            end=core.Position(line, 5, 4),
+        )
+
+        snippet, start_highlight, _ = SarifFormatter._generate_taint_snippet(location)
+
+        # the context before the location is cut off at the top of the file
+        assert snippet == expected
+        assert start_highlight == len("line 1\n") * (line - 1) + 1
+
+
+@pytest.mark.quick
+def test_sarif_output_keys_are_sorted(mocker):
+    # format() relies on every dict being built with its keys in sorted order,
+    # instead of json.dumps(sort_keys=True), so exercise all the optional keys
+    file_content = "".join(f"line {i}\n" for i in range(1, 21))
+    mocker.patch.object(Path, "open", mocker.mock_open(read_data=file_content))
+    mocker.patch.object(builtins, "open", mocker.mock_open(read_data=file_content))
+    r = """
+      id: rule.id
+      languages: [python]
+      severity: ERROR
+      message: blah
+      pattern: blah(...)
+      metadata:
+        security-severity: "7.5"
+        source: https://semgrep.dev/r/rule.id
+        references:
+        - https://example.com
+        cwe:
+        - CWE-22
+    """
+    with StringIO(r) as stream:
+        j = yaml.load(stream)
+    rule = Rule.from_yamltree(YamlTree.wrap(j, EmptySpan))
+    taint_rule_match = create_taint_rule_match(
+        metadata={"sca-kind": "upgrade-only"},
+        extra={"fixed_lines": ["fixed"], "sca_info": None},
+        is_ignored=True,
+    )
+
+    output = SarifFormatter().format(
+        [rule],
+        [taint_rule_match],
+        [SemgrepError("error")],
+        core.CliOutputExtra(paths=core.CliPaths(scanned=[])),
+        {"dataflow_traces": True},
+        is_ci_invocation=False,
+    )
+    sarif = json.loads(output)
+
+    run = sarif["runs"][0]
+    rule_sarif = run["tool"]["driver"]["rules"][0]
+    assert {"help", "helpUri"} <= rule_sarif.keys()
+    assert "markdown" in rule_sarif["help"]
+    assert "security-severity" in rule_sarif["properties"]
+    result = run["results"][0]
+    assert {"codeFlows", "fixes", "suppressions"} <= result.keys()
+    assert "exposure" in result["properties"]
+    thread_flow_locations = result["codeFlows"][0]["threadFlows"][0]["locations"]
+    assert any("nestingLevel" in location for location in thread_flow_locations)
+    assert run["invocations"][0]["toolExecutionNotifications"]
+
+    assert json.dumps(sarif) == json.dumps(sarif, sort_keys=True)
+
+
+@pytest.mark.quick
+@pytest.mark.parametrize(
+    "obj",
+    [
+        {"message": "plain ascii", "lines": ["a", "b"], "level": 2, "empty": {}},
+        {"message": 'caf\u00e9 \u2603 \U0001f600 \x7f \x00\t\n\x1f"\\'},
+        {"\u00e9": [None, True, False, -1, 2**63]},
+        {"big": 2**64, "ok": [1]},
+        {"security-severity": 1e16, "small": 1e-7, "nan": float("nan")},
+    ],
+)
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_sarif_json_dumps_matches_json(obj, use_orjson, monkeypatch):
+    if use_orjson:
+        pytest.importorskip("orjson")
+    else:
+        monkeypatch.setattr(sarif, "orjson", None)
+    assert sarif._json_dumps(obj) == json.dumps(obj, indent=2)
+
+
+@pytest.mark.quick
+def test_sarif_json_dumps_float_parts():
+    pytest.importorskip("orjson")
+    obj = {"results": [{"line": 1}], "rules": [{"security-severity": 1e-7}]}
+    assert sarif._json_dumps(obj, [obj["rules"]]) == json.dumps(obj, indent=2)